@@ -1,99 +1,137 @@
 import sqlite3
 import json
-from typing import Optional, Any, Dict, List, Tuple
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Optional, Any, Dict, List, Tuple, Iterator
 from datetime import datetime, timezone
 
 DB_PATH = "bot.db"
 
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+
+# bumped (under _conn_lock) on every write to prompts; keys the list_prompts cache
+_prompts_version = 0
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    # one long-lived connection per process: no open/close per call, and the page cache and
+    # sqlite3's prepared-statement cache stay warm. Helpers are called from worker threads,
+    # so access is serialized by a lock; leaving the block commits (or rolls back on error).
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            _conn.row_factory = sqlite3.Row
+            _conn.execute("PRAGMA synchronous=NORMAL;")  # safe with WAL, no fsync per commit
+            _conn.execute("PRAGMA temp_store=MEMORY;")
+            _conn.execute("PRAGMA mmap_size=268435456;")
+            _conn.execute("PRAGMA cache_size=-64000;")  # ~64MB page cache
+            _conn.execute("PRAGMA busy_timeout=5000;")
+        with _conn:
+            yield _conn
+
+
+_now_cache: Tuple[int, str] = (0, "")
+
 
 def _utcnow() -> str:
-    return datetime.now(timezone.utc).isoformat()
+    # timestamps only need 1s resolution — reuse the formatted string within the same second
+    global _now_cache
+    sec = int(time.time())
+    if _now_cache[0] != sec:
+        _now_cache = (sec, datetime.fromtimestamp(sec, timezone.utc).isoformat())
+    return _now_cache[1]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    is_vip INTEGER DEFAULT 0,
+    credits INTEGER DEFAULT 0,
+    notify_new_prompts INTEGER DEFAULT 1,
+    referrals_count INTEGER DEFAULT 0,
+    state TEXT,
+    state_payload TEXT,
+    created_at TEXT,
+    last_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    prompt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    tags TEXT,
+    source TEXT,
+    source_chat_id TEXT,
+    source_post_id TEXT,
+    created_by INTEGER,
+    created_at TEXT,
+    is_new INTEGER DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS favorites (
+    user_id INTEGER NOT NULL,
+    prompt_id INTEGER NOT NULL,
+    created_at TEXT,
+    PRIMARY KEY (user_id, prompt_id)
+);
+CREATE TABLE IF NOT EXISTS referrals (
+    referrer_id INTEGER NOT NULL,
+    referred_id INTEGER NOT NULL,
+    created_at TEXT,
+    PRIMARY KEY (referrer_id, referred_id)
+);
+CREATE TABLE IF NOT EXISTS freepik_tasks (
+    task_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_prompts_new ON prompts(is_new, prompt_id);
+CREATE INDEX IF NOT EXISTS idx_users_notify ON users(notify_new_prompts, user_id);
+"""
 
 
 def init_db() -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            is_vip INTEGER DEFAULT 0,
-            credits INTEGER DEFAULT 0,
-            notify_new_prompts INTEGER DEFAULT 1,
-            referrals_count INTEGER DEFAULT 0,
-            state TEXT,
-            state_payload TEXT,
-            created_at TEXT,
-            last_seen TEXT
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS prompts (
-            prompt_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            text TEXT NOT NULL,
-            tags TEXT,
-            source TEXT,
-            source_chat_id TEXT,
-            source_post_id TEXT,
-            created_by INTEGER,
-            created_at TEXT,
-            is_new INTEGER DEFAULT 1
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS favorites (
-            user_id INTEGER NOT NULL,
-            prompt_id INTEGER NOT NULL,
-            created_at TEXT,
-            PRIMARY KEY (user_id, prompt_id)
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            referrer_id INTEGER NOT NULL,
-            referred_id INTEGER NOT NULL,
-            created_at TEXT,
-            PRIMARY KEY (referrer_id, referred_id)
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS freepik_tasks (
-            task_id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            chat_id INTEGER NOT NULL,
-            kind TEXT NOT NULL,
-            created_at TEXT
-        )
-        """)
-        conn.commit()
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL;")  # can't be changed inside a transaction
+        # whole schema in one script and one transaction: a single parse + commit on boot
+        conn.executescript("BEGIN;\n" + SCHEMA + "COMMIT;")
+
+
+def optimize_db() -> None:
+    # cheap when nothing changed; refreshes planner stats for tables that need it
+    with _connect() as conn:
+        conn.execute("PRAGMA optimize;")
+
+
+def _upsert_user(conn: sqlite3.Connection, user_id: int, username: str | None, first_name: str | None) -> None:
+    now = _utcnow()
+    conn.execute("""
+        INSERT INTO users(user_id, username, first_name, created_at, last_seen)
+        VALUES(?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username=excluded.username, first_name=excluded.first_name, last_seen=excluded.last_seen
+    """, (user_id, username, first_name, now, now))
 
 
 def upsert_user(user_id: int, username: str | None, first_name: str | None) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,)).fetchone()
-        if row:
-            conn.execute("""
-                UPDATE users SET username=?, first_name=?, last_seen=?
-                WHERE user_id=?
-            """, (username, first_name, _utcnow(), user_id))
-        else:
-            conn.execute("""
-                INSERT INTO users(user_id, username, first_name, created_at, last_seen)
-                VALUES(?,?,?,?,?)
-            """, (user_id, username, first_name, _utcnow(), _utcnow()))
-        conn.commit()
+    with _connect() as conn:
+        _upsert_user(conn, user_id, username, first_name)
 
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
+    with _connect() as conn:
         row = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
         return dict(row) if row else None
 
 
 def set_state(user_id: int, state: Optional[str], payload: Optional[Dict[str, Any]] = None) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.execute("""
             UPDATE users SET state=?, state_payload=?, last_seen=?
             WHERE user_id=?
@@ -102,106 +140,138 @@ def set_state(user_id: int, state: Optional[str], payload: Optional[Dict[str, An
 
 
 def get_state(user_id: int) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
-    u = get_user(user_id)
-    if not u:
+    # runs on every text/photo: read just the two state columns, not the whole user row
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None  # plain tuple: unpacked below, no sqlite3.Row name lookups
+        row = cur.execute("SELECT state, state_payload FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if not row:
         return None, None
-    state = u.get("state")
-    payload_raw = u.get("state_payload")
+    state, payload_raw = row
     payload = json.loads(payload_raw) if payload_raw else None
     return state, payload
 
 
 def set_vip(user_id: int, is_vip: bool) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.execute("UPDATE users SET is_vip=?, last_seen=? WHERE user_id=?",
                      (1 if is_vip else 0, _utcnow(), user_id))
         conn.commit()
 
 
 def toggle_notify(user_id: int) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute("SELECT notify_new_prompts FROM users WHERE user_id=?", (user_id,)).fetchone()
-        cur = int(row[0]) if row else 1
-        newv = 0 if cur == 1 else 1
-        conn.execute("UPDATE users SET notify_new_prompts=?, last_seen=? WHERE user_id=?",
-                     (newv, _utcnow(), user_id))
+    # flip and read back in one statement instead of SELECT + UPDATE
+    with _connect() as conn:
+        row = conn.execute("""
+            UPDATE users SET notify_new_prompts = 1 - notify_new_prompts, last_seen=?
+            WHERE user_id=?
+            RETURNING notify_new_prompts
+        """, (_utcnow(), user_id)).fetchone()
         conn.commit()
-        return newv
+        return int(row[0]) if row else 0
 
 
-def list_notified_users() -> List[int]:
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT user_id FROM users WHERE notify_new_prompts=1").fetchall()
+def list_notified_users(after_user_id: int = 0, limit: int = -1) -> List[int]:
+    # keyset paging (user_id > after_user_id) so callers can walk a large audience batch by batch
+    with _connect() as conn:
+        rows = conn.execute("""
+            SELECT user_id FROM users WHERE notify_new_prompts=1 AND user_id > ?
+            ORDER BY user_id LIMIT ?
+        """, (after_user_id, limit)).fetchall()
         return [int(r[0]) for r in rows]
 
 
-def add_prompt(
-    text: str,
+def _bump_prompts_version() -> None:
+    global _prompts_version
+    _prompts_version += 1
+
+
+def add_prompts(
+    texts: List[str],
     tags: str | None = None,
     source: str | None = None,
     source_chat_id: str | None = None,
     source_post_id: str | None = None,
     created_by: int | None = None
-) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("""
+) -> None:
+    # all prompts of one comment go in a single transaction (one commit instead of one per prompt)
+    now = _utcnow()
+    with _connect() as conn:
+        conn.executemany("""
             INSERT INTO prompts(text, tags, source, source_chat_id, source_post_id, created_by, created_at, is_new)
             VALUES(?,?,?,?,?,?,?,1)
-        """, (text, tags, source, source_chat_id, source_post_id, created_by, _utcnow()))
+        """, [(t, tags, source, source_chat_id, source_post_id, created_by, now) for t in texts])
         conn.commit()
-        return int(cur.lastrowid)
+        _bump_prompts_version()
+
 
+def list_prompts(limit: int = 10, only_new: bool = False, preview_len: Optional[int] = None) -> List[Dict[str, Any]]:
+    # the library rarely changes between clicks: serve repeats from memory until the next prompts write
+    return list(_list_prompts(_prompts_version, limit, only_new, preview_len))
 
-def list_prompts(limit: int = 10, only_new: bool = False) -> List[Dict[str, Any]]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
+
+@functools.lru_cache(maxsize=16)
+def _list_prompts(version: int, limit: int, only_new: bool,
+                  preview_len: Optional[int]) -> Tuple[Dict[str, Any], ...]:
+    # preview_len: list screens only show the head of each prompt, so cut it in SQL and
+    # return just prompt_id + text instead of copying every full row into Python
+    cols = "prompt_id, substr(text, 1, ?) AS text" if preview_len else "*"
+    params: Tuple[Any, ...] = (preview_len, limit) if preview_len else (limit,)
+    with _connect() as conn:
         if only_new:
-            rows = conn.execute("""
-                SELECT * FROM prompts WHERE is_new=1 ORDER BY prompt_id DESC LIMIT ?
-            """, (limit,)).fetchall()
+            rows = conn.execute(f"""
+                SELECT {cols} FROM prompts WHERE is_new=1 ORDER BY prompt_id DESC LIMIT ?
+            """, params).fetchall()
         else:
-            rows = conn.execute("""
-                SELECT * FROM prompts ORDER BY prompt_id DESC LIMIT ?
-            """, (limit,)).fetchall()
-        return [dict(r) for r in rows]
+            rows = conn.execute(f"""
+                SELECT {cols} FROM prompts ORDER BY prompt_id DESC LIMIT ?
+            """, params).fetchall()
+        return tuple(dict(r) for r in rows)
 
 
-def mark_prompt_seen(prompt_id: int) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("UPDATE prompts SET is_new=0 WHERE prompt_id=?", (prompt_id,))
+def mark_prompts_seen(prompt_ids: List[int]) -> None:
+    # one transaction for the whole "new prompts" page instead of a commit per prompt
+    with _connect() as conn:
+        conn.executemany("UPDATE prompts SET is_new=0 WHERE prompt_id=?", [(pid,) for pid in prompt_ids])
         conn.commit()
+        _bump_prompts_version()
 
 
 def toggle_favorite(user_id: int, prompt_id: int) -> bool:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute("SELECT 1 FROM favorites WHERE user_id=? AND prompt_id=?", (user_id, prompt_id)).fetchone()
-        if row:
-            conn.execute("DELETE FROM favorites WHERE user_id=? AND prompt_id=?", (user_id, prompt_id))
-            conn.commit()
+    # try the removal first: rowcount tells whether it was a favorite, so no SELECT round-trip
+    with _connect() as conn:
+        cur = conn.execute("DELETE FROM favorites WHERE user_id=? AND prompt_id=?", (user_id, prompt_id))
+        if cur.rowcount:
             return False
         conn.execute("INSERT INTO favorites(user_id, prompt_id, created_at) VALUES(?,?,?)",
                      (user_id, prompt_id, _utcnow()))
-        conn.commit()
         return True
 
 
-def add_referral(referrer_id: int, referred_id: int) -> bool:
+def _add_referral(conn: sqlite3.Connection, referrer_id: int, referred_id: int) -> bool:
     if referrer_id == referred_id:
         return False
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute("SELECT 1 FROM referrals WHERE referrer_id=? AND referred_id=?",
-                           (referrer_id, referred_id)).fetchone()
-        if row:
-            return False
-        conn.execute("INSERT INTO referrals(referrer_id, referred_id, created_at) VALUES(?,?,?)",
-                     (referrer_id, referred_id, _utcnow()))
-        conn.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id=?", (referrer_id,))
-        conn.commit()
-        return True
+    # the primary key does the duplicate check; rowcount is 0 when the pair already exists
+    cur = conn.execute("INSERT OR IGNORE INTO referrals(referrer_id, referred_id, created_at) VALUES(?,?,?)",
+                       (referrer_id, referred_id, _utcnow()))
+    if cur.rowcount == 0:
+        return False
+    conn.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id=?", (referrer_id,))
+    return True
+
+
+def register_start(user_id: int, username: str | None, first_name: str | None,
+                   referrer_id: Optional[int] = None) -> bool:
+    # /start: user upsert + referral in one transaction (one commit instead of two)
+    with _connect() as conn:
+        _upsert_user(conn, user_id, username, first_name)
+        if referrer_id:
+            return _add_referral(conn, referrer_id, user_id)
+        return False
 
 
 def add_freepik_task(task_id: str, user_id: int, chat_id: int, kind: str) -> None:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.execute("""
             INSERT OR REPLACE INTO freepik_tasks(task_id, user_id, chat_id, kind, created_at)
             VALUES(?,?,?,?,?)
@@ -210,7 +280,6 @@ def add_freepik_task(task_id: str, user_id: int, chat_id: int, kind: str) -> Non
 
 
 def get_freepik_task(task_id: str) -> Optional[Dict[str, Any]]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
+    with _connect() as conn:
         row = conn.execute("SELECT * FROM freepik_tasks WHERE task_id=?", (task_id,)).fetchone()
         return dict(row) if row else None
@@ -1,12 +1,72 @@
+import asyncio
+import logging
+import random
+import time
 import httpx
 from typing import Any, Dict, Optional
 
 FREEPIK_BASE = "https://api.freepik.com"
 
+# answers that mean the task was not accepted, so re-sending can't create a duplicate
+# generation; 500/502/504 may arrive after Freepik already queued the job, so they are raised
+RETRY_STATUSES = {429, 503}
+MAX_RETRY_WAIT = 30.0  # seconds; also caps the server's Retry-After
+
+log = logging.getLogger(__name__)
+
+
+def _retry_after(r: httpx.Response) -> Optional[float]:
+    try:
+        return min(float(r.headers.get("retry-after", "")), MAX_RETRY_WAIT)
+    except ValueError:
+        return None
+
+
+class AsyncTokenBucket:
+    # requests-per-minute limiter shared by every caller of one client:
+    # callers wait here instead of bursting into 429s
+    def __init__(self, rpm: int):
+        self.capacity = float(rpm)
+        self.tokens = float(rpm)
+        self.rate = rpm / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
 class FreepikClient:
-    def __init__(self, api_key: str, timeout: float = 60.0):
+    def __init__(self, api_key: str, timeout: float = 60.0, max_attempts: int = 4, rpm: int = 0):
         self.api_key = api_key
         self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._bucket = AsyncTokenBucket(rpm) if rpm > 0 else None  # rpm=0 -> no client-side limit
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # one pooled client for the whole process: keeps TLS/HTTP2 connections alive between calls
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=FREEPIK_BASE,
+                timeout=self.timeout,
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     def _headers(self) -> Dict[str, str]:
         # Freepik auth header is x-freepik-api-key :contentReference[oaicite:4]{index=4}
@@ -17,11 +77,28 @@ class FreepikClient:
         }
 
     async def post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = f"{FREEPIK_BASE}{path}"
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            return r.json()
+        # exponential backoff with full jitter; only connect failures and 429/503 are retried,
+        # so a request the API may already have accepted (read timeout, 500/502/504) is never sent twice
+        backoff = 1.0
+        for attempt in range(1, self.max_attempts + 1):
+            if self._bucket:
+                await self._bucket.acquire()
+            try:
+                r = await self._get_client().post(path, headers=self._headers(), json=payload)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt == self.max_attempts:
+                    raise
+                wait = random.uniform(0, backoff)
+                log.warning("Freepik %s: %s, retry %d in %.1fs", path, e, attempt, wait)
+            else:
+                if r.status_code not in RETRY_STATUSES or attempt == self.max_attempts:
+                    r.raise_for_status()
+                    return r.json()
+                wait = _retry_after(r) or random.uniform(0, backoff)
+                log.warning("Freepik %s: HTTP %d, retry %d in %.1fs", path, r.status_code, attempt, wait)
+            await asyncio.sleep(wait)
+            backoff = min(backoff * 2, MAX_RETRY_WAIT)
+        raise RuntimeError("unreachable")
 
     # --------- Image (Text->Image) ----------
     async def text_to_image_flux_dev(self, prompt: str, webhook_url: str, **kwargs) -> Dict[str, Any]:
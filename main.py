@@ -1,20 +1,35 @@
 import os
-import json
+import re
 import base64
 import hmac
 import hashlib
-from typing import Any, Dict, Optional
-
+import logging
+import time
+import asyncio
+import functools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
 from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi.responses import ORJSONResponse
 from telegram import (
     Update,
+    User,
+    CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     LabeledPrice,
 )
-from telegram.constants import ParseMode
+from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -25,12 +40,17 @@ from telegram.ext import (
 
 from db import (
     init_db, upsert_user, get_user, set_state, get_state, set_vip,
-    add_prompt, list_prompts, mark_prompt_seen, toggle_favorite,
-    add_referral, list_notified_users, toggle_notify,
-    add_freepik_task, get_freepik_task
+    add_prompts, list_prompts, mark_prompts_seen, toggle_favorite,
+    register_start, list_notified_users, toggle_notify,
+    add_freepik_task, get_freepik_task, optimize_db
 )
 from freepik_client import FreepikClient
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+# httpx logs every request at INFO; with Bot API + Freepik traffic that is a line per call
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log = logging.getLogger("bot")
+
 
 # ---------------- ENV ----------------
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
@@ -48,9 +68,29 @@ OWNER_USER_ID = int(os.getenv("OWNER_USER_ID", "0") or "0")
 
 FREEPIK_API_KEY = os.getenv("FREEPIK_API_KEY", "").strip()
 FREEPIK_WEBHOOK_SECRET = os.getenv("FREEPIK_WEBHOOK_SECRET", "").strip()  # for verifying Freepik webhook signature
+FREEPIK_RPM = int(os.getenv("FREEPIK_RPM", "0") or "0")  # requests/min cap for Freepik API, 0 = no limit
 
 VIP_STARS_PRICE = int(os.getenv("VIP_STARS_PRICE", "299") or "299")  # 299 Stars
 
+BROADCAST_CONCURRENCY = 25  # parallel sends during a new-prompt broadcast
+BROADCAST_SEND_INTERVAL = 0.04  # seconds between sends (~25 msg/s)
+BROADCAST_PAGE_SIZE = 100  # user ids loaded from the DB per batch
+
+DB_OPTIMIZE_INTERVAL = 15 * 60  # seconds between PRAGMA optimize runs
+
+USER_TOUCH_TTL = 300  # seconds between last_seen refreshes for an unchanged user
+
+SUB_OK_TTL = 300  # seconds to trust a positive subscription check before asking Telegram again
+SUB_FAIL_TTL = 15  # short negative cache, so users who just subscribed get through quickly
+# Telegram returns statuses: member/administrator/creator (ChatMemberStatus is a str enum)
+SUBSCRIBED_STATUSES = frozenset({"member", "administrator", "creator"})
+
+GEN_BURST = 5  # Freepik generations a user may start back to back
+GEN_PER_MINUTE = 5  # sustained generations per user per minute after the burst
+
+WEBHOOK_MAX_CONNECTIONS = 100  # parallel webhook deliveries Telegram may open (1-100)
+SEEN_UPDATES_MAX = 4096  # recent update_ids remembered to drop Telegram webhook retries
+
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN env var")
@@ -68,56 +108,179 @@ if not FREEPIK_API_KEY:
     raise RuntimeError("Missing FREEPIK_API_KEY env var")
 
 # ---------------- APP INIT ----------------
-app = FastAPI()
-tg_app: Application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-freepik = FreepikClient(FREEPIK_API_KEY)
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # on_startup/on_shutdown are defined at the bottom, after the handlers they register;
+    # on_shutdown also runs when startup fails halfway, and copes with whatever got started
+    try:
+        await on_startup()
+        yield
+    finally:
+        await on_shutdown()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# explicit pool for outbound Bot API calls: room for broadcast + handler sends, and a pool wait
+# long enough that bursts queue instead of failing with "Pool timeout"
+tg_app: Application = (
+    Application.builder()
+    .token(TELEGRAM_BOT_TOKEN)
+    .request(HTTPXRequest(connection_pool_size=64, pool_timeout=20.0, connect_timeout=10.0, read_timeout=30.0))
+    # smooths bursts under Telegram's ~30 msg/s cap and retries 429s instead of failing the send;
+    # no group limit: the bot doesn't post into groups, and the limiter would count the
+    # channel's getChatMember checks (@channel / -100... chat_id) against 20/min
+    .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=0, max_retries=3))
+    .build()
+)
+freepik = FreepikClient(FREEPIK_API_KEY, rpm=FREEPIK_RPM)
+
 
-init_db()
+_broadcast_queue: "asyncio.Queue[tuple[int, int]]" = asyncio.Queue()
+_background_tasks: list["asyncio.Task[None]"] = []
+_seen_updates: "OrderedDict[int, None]" = OrderedDict()
+# per-user lock + number of that user's updates holding/waiting on it; dropped when idle
+_user_locks: Dict[int, list] = {}
 
 
 # ---------------- UI ----------------
-def kb_main() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🖼️ Фото", callback_data="m:image"),
-         InlineKeyboardButton("🎥 Видео", callback_data="m:video")],
-        [InlineKeyboardButton("📚 База промптов", callback_data="m:library"),
-         InlineKeyboardButton("🆕 Новые промты", callback_data="m:new")],
-        [InlineKeyboardButton("⭐ VIP", callback_data="m:vip"),
-         InlineKeyboardButton("🎁 Реферал", callback_data="m:ref")],
-        [InlineKeyboardButton("🔔 Уведомления", callback_data="m:notify"),
-         InlineKeyboardButton("📷 Instagram", url=os.getenv("INSTAGRAM_URL", "https://instagram.com"))],
-    ])
-
-def kb_subscribe() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Подписаться", url=REQUIRED_CHANNEL_URL)],
-        [InlineKeyboardButton("🔄 Проверить подписку", callback_data="check_sub")]
-    ])
-
-def kb_image_models() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Flux Dev (быстро)", callback_data="img:flux"),
-         InlineKeyboardButton("HyperFlux (качество)", callback_data="img:hyper")],
-        [InlineKeyboardButton("Mystic (арт/стиль)", callback_data="img:mystic")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="m:back")]
-    ])
-
-def kb_video_models() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Kling Standard", callback_data="vid:kling_std"),
-         InlineKeyboardButton("Kling Pro", callback_data="vid:kling_pro")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="m:back")]
-    ])
+# keyboards are static, so build them once instead of on every update
+_BACK_ROW = [InlineKeyboardButton("⬅️ Назад", callback_data="m:back")]
+
+KB_MAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🖼️ Фото", callback_data="m:image"),
+     InlineKeyboardButton("🎥 Видео", callback_data="m:video")],
+    [InlineKeyboardButton("📚 База промптов", callback_data="m:library"),
+     InlineKeyboardButton("🆕 Новые промты", callback_data="m:new")],
+    [InlineKeyboardButton("⭐ VIP", callback_data="m:vip"),
+     InlineKeyboardButton("🎁 Реферал", callback_data="m:ref")],
+    [InlineKeyboardButton("🔔 Уведомления", callback_data="m:notify"),
+     InlineKeyboardButton("📷 Instagram", url=os.getenv("INSTAGRAM_URL", "https://instagram.com"))],
+])
+
+KB_SUBSCRIBE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Подписаться", url=REQUIRED_CHANNEL_URL)],
+    [InlineKeyboardButton("🔄 Проверить подписку", callback_data="check_sub")]
+])
+
+KB_IMAGE_MODELS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Flux Dev (быстро)", callback_data="img:flux"),
+     InlineKeyboardButton("HyperFlux (качество)", callback_data="img:hyper")],
+    [InlineKeyboardButton("Mystic (арт/стиль)", callback_data="img:mystic")],
+    _BACK_ROW,
+])
+
+KB_VIDEO_MODELS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Kling Standard", callback_data="vid:kling_std"),
+     InlineKeyboardButton("Kling Pro", callback_data="vid:kling_pro")],
+    _BACK_ROW,
+])
+
+KB_VIP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"Купить за {VIP_STARS_PRICE} ⭐", callback_data="vip:buy")],
+    _BACK_ROW,
+])
+
+# canned texts depend only on env constants — format them once
+MENU_TEXT = "🔥 *Gurenko AI Agent* — выбирай, что делаем:"
+
+GATE_TEXT = (
+    "🔒 Доступ закрыт.\n\n"
+    f"Чтобы пользоваться ботом — подпишись на канал {REQUIRED_CHANNEL} и нажми «Проверить подписку»."
+)
+
+VIP_TEXT = (
+    "⭐ *VIP доступ*\n\n"
+    f"Цена: *{VIP_STARS_PRICE} ⭐*\n"
+    "VIP даёт приоритет, больше генераций, доступ к спец-разделам."
+)
+
+# Stars invoices use currency XTR and empty provider_token; only chat_id varies per click
+VIP_PRICES = [LabeledPrice(label="VIP доступ", amount=VIP_STARS_PRICE)]
+VIP_INVOICE = dict(
+    title="VIP доступ",
+    description="VIP доступ к Gurenko AI Agent",
+    payload="vip_299",
+    provider_token="",  # for Stars
+    currency="XTR",
+    prices=VIP_PRICES,
+)
+
+# static parts of the referral screen; only the bot username and user id are filled per click
+REF_TEXT = (
+    "🎁 *Твоя реферальная ссылка:*\n"
+    "https://t.me/{bot}?start=ref_{user_id}\n\n"
+    "За каждого приглашённого — бонусы (можно настроить: VIP/кредиты)."
+)
+
+RATE_LIMIT_TEXT = "⏳ Слишком часто. Подожди минуту и пришли промпт ещё раз."
+
+HELP_TEXT = (
+    "Команды:\n"
+    "/start — меню\n"
+    "/myid — узнать свой Telegram user id\n"
+    "/help — помощь"
+)
 
 
 # ---------------- HELPERS ----------------
-async def is_subscribed(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    # Telegram returns statuses: member/administrator/creator
+# db.py shares one connection behind a lock, so extra threads would only queue on it;
+# a dedicated single worker keeps DB calls in order and off the default executor
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+async def _db(fn, *args, **kwargs):
+    # sqlite3 calls block; run them in the DB thread so the event loop keeps serving other updates
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+
+async def is_subscribed(user_id: int, context: ContextTypes.DEFAULT_TYPE, force: bool = False) -> bool:
+    # cached per user in user_data as (ok, checked_at); force=True skips the cache
+    cached = context.user_data.get("_sub")
+    if cached and not force:
+        ok, checked_at = cached
+        if time.monotonic() - checked_at < (SUB_OK_TTL if ok else SUB_FAIL_TTL):
+            return ok
     try:
         member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        return member.status in ("member", "administrator", "creator")
+        ok = member.status in SUBSCRIBED_STATUSES
     except Exception:
+        ok = False
+    context.user_data["_sub"] = (ok, time.monotonic())
+    return ok
+
+async def touch_user(user: User, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # upsert_user on every click is mostly a no-op rewrite of the same row:
+    # only write when name/username changed or the last write is older than USER_TOUCH_TTL
+    key = (user.username, user.first_name)
+    last = context.user_data.get("_touched")
+    if last and last[0] == key and time.monotonic() - last[1] < USER_TOUCH_TTL:
+        return
+    await _db(upsert_user, user.id, user.username, user.first_name)
+    context.user_data["_touched"] = (key, time.monotonic())
+
+def take_gen_token(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # per-user token bucket kept in user_data as (tokens, refilled_at); owner is never limited
+    if OWNER_USER_ID and user_id == OWNER_USER_ID:
+        return True
+    now = time.monotonic()
+    tokens, refilled_at = context.user_data.get("_gen", (GEN_BURST, now))
+    tokens = min(GEN_BURST, tokens + (now - refilled_at) * GEN_PER_MINUTE / 60)
+    if tokens < 1:
+        context.user_data["_gen"] = (tokens, now)
         return False
+    context.user_data["_gen"] = (tokens - 1, now)
+    return True
+
+async def load_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    # on_video_text and on_text both run for every text message: read the state once per update
+    cached = context.user_data.get("_state")
+    if cached and cached[0] == update.update_id:
+        return cached[1]
+    res = await _db(get_state, update.effective_user.id)
+    context.user_data["_state"] = (update.update_id, res)
+    return res
+
+async def save_state(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                     state: Optional[str], payload: Optional[Dict[str, Any]]) -> None:
+    await _db(set_state, update.effective_user.id, state, payload)
+    context.user_data["_state"] = (update.update_id, (state, payload))
 
 async def gate_or_ask_sub(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
@@ -127,15 +290,11 @@ async def gate_or_ask_sub(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if ok:
         return True
 
-    text = (
-        "🔒 Доступ закрыт.\n\n"
-        f"Чтобы пользоваться ботом — подпишись на канал {REQUIRED_CHANNEL} и нажми «Проверить подписку»."
-    )
     if update.message:
-        await update.message.reply_text(text, reply_markup=kb_subscribe())
+        await update.message.reply_text(GATE_TEXT, reply_markup=KB_SUBSCRIBE)
     elif update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.message.reply_text(text, reply_markup=kb_subscribe())
+        await update.callback_query.message.reply_text(GATE_TEXT, reply_markup=KB_SUBSCRIBE)
     return False
 
 def _parse_ref(start_arg: str) -> Optional[int]:
@@ -144,11 +303,17 @@ def _parse_ref(start_arg: str) -> Optional[int]:
         return None
     if start_arg.startswith("ref_"):
         try:
-            return int(start_arg.replace("ref_", "").strip())
+            return int(start_arg[len("ref_"):])
         except Exception:
             return None
     return None
 
+# compiled once; case-insensitive search instead of re-uppercasing the comment for every check
+_PROMPT_MARKERS = (
+    re.compile(r"ПРОМТ:", re.IGNORECASE),
+    re.compile(r"PROMPT:", re.IGNORECASE),
+)
+
 def _extract_prompts_from_comment(text: str) -> list[str]:
     """
     Логика максимально практичная для твоего формата:
@@ -159,13 +324,11 @@ def _extract_prompts_from_comment(text: str) -> list[str]:
     if not text:
         return []
     cleaned = text.strip()
-    if "ПРОМТ:" in cleaned.upper():
-        # берём после первого "ПРОМТ:"
-        idx = cleaned.upper().find("ПРОМТ:")
-        cleaned = cleaned[idx + len("ПРОМТ:"):].strip()
-    if "PROMPT:" in cleaned.upper():
-        idx = cleaned.upper().find("PROMPT:")
-        cleaned = cleaned[idx + len("PROMPT:"):].strip()
+    # берём после первого "ПРОМТ:", затем после первого "PROMPT:"
+    for marker in _PROMPT_MARKERS:
+        m = marker.search(cleaned)
+        if m:
+            cleaned = cleaned[m.end():].strip()
 
     parts = [p.strip(" \t\r\n•-—") for p in cleaned.split("\n")]
     out = []
@@ -177,37 +340,76 @@ def _extract_prompts_from_comment(text: str) -> list[str]:
         out = [cleaned]
     return out
 
+def _b64encode(data: bytes | bytearray) -> str:
+    return base64.b64encode(data).decode("utf-8")
+
+def _extract_task_id(res: Dict[str, Any]) -> str:
+    # ожидаем что Freepik вернет task id
+    return str(res.get("id") or (res.get("data") or {}).get("id") or res.get("task_id") or "")
+
 async def send_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.send_message(
         chat_id=chat_id,
-        text="🔥 *Gurenko AI Agent* — выбирай, что делаем:",
+        text=MENU_TEXT,
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb_main()
+        reply_markup=KB_MAIN
     )
 
-async def broadcast_new_prompt(prompt_text: str, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # аккуратно: можно выключить у пользователя через "Уведомления"
-    user_ids = list_notified_users()
-    msg = "🆕 *Новый промпт из канала:*\n\n" + prompt_text
-    for uid in user_ids:
+async def _send_broadcast(uid: int, from_chat_id: int, message_id: int, sem: asyncio.Semaphore) -> None:
+    async with sem:
+        # 429s are retried by the AIORateLimiter; anything else (blocked bot, deleted chat) is skipped
         try:
-            await context.bot.send_message(uid, msg, parse_mode=ParseMode.MARKDOWN)
+            await tg_app.bot.copy_message(uid, from_chat_id=from_chat_id, message_id=message_id)
         except Exception:
             pass
 
+async def broadcast_worker() -> None:
+    # один воркер на процесс: посты из канала встают в очередь и рассылаются по одному
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    while True:
+        from_chat_id, message_id = await _broadcast_queue.get()
+        try:
+            # аккуратно: можно выключить у пользователя через "Уведомления"
+            after = 0
+            while True:
+                user_ids = await _db(list_notified_users, after_user_id=after, limit=BROADCAST_PAGE_SIZE)
+                if not user_ids:
+                    break
+                tasks = []
+                for uid in user_ids:
+                    tasks.append(asyncio.create_task(_send_broadcast(uid, from_chat_id, message_id, sem)))
+                    # pace launches to stay under Telegram's ~30 msg/s global limit
+                    await asyncio.sleep(BROADCAST_SEND_INTERVAL)
+                await asyncio.gather(*tasks)
+                after = user_ids[-1]
+        except Exception:
+            log.exception("Broadcast of message %s from chat %s stopped after user_id %s",
+                          message_id, from_chat_id, after)
+        finally:
+            _broadcast_queue.task_done()
+
+async def db_optimize_worker() -> None:
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await _db(optimize_db)
+        except Exception:
+            log.exception("PRAGMA optimize failed")
+
+def broadcast_new_prompt(from_chat_id: int, message_id: int) -> None:
+    # handler returns immediately; broadcast_worker copies the comment to subscribers in the background
+    _broadcast_queue.put_nowait((from_chat_id, message_id))
+
 
 # ---------------- COMMANDS ----------------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
         return
-    upsert_user(user.id, user.username, user.first_name)
-
-    # referral
-    if context.args:
-        ref = _parse_ref(context.args[0])
-        if ref:
-            add_referral(referrer_id=ref, referred_id=user.id)
+    # upsert + referral in one transaction
+    ref = _parse_ref(context.args[0]) if context.args else None
+    await _db(register_start, user.id, user.username, user.first_name, referrer_id=ref)
+    context.user_data["_touched"] = ((user.username, user.first_name), time.monotonic())
 
     # gate
     if not await gate_or_ask_sub(update, context):
@@ -222,15 +424,108 @@ async def cmd_myid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(f"Твой user_id: `{user.id}`", parse_mode=ParseMode.MARKDOWN)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        "Команды:\n"
-        "/start — меню\n"
-        "/myid — узнать свой Telegram user id\n"
-        "/help — помощь"
-    )
+    await update.message.reply_text(HELP_TEXT)
 
 
 # ---------------- CALLBACKS (MENU) ----------------
+# each button has its own handler: (update, context, query, user, arg), where arg is
+# the part after "img:"/"vid:" for prefixed buttons and "" for static ones
+async def _cb_check_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    ok = await is_subscribed(user.id, context, force=True)
+    if not ok:
+        await q.message.reply_text("Пока не вижу подписку 😕 Подпишись и нажми ещё раз.", reply_markup=KB_SUBSCRIBE)
+        return
+    await q.message.reply_text("✅ Подписка подтверждена! Добро пожаловать 🔥")
+    await send_menu(q.message.chat_id, context)
+
+async def _cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    # turn the current message back into the menu instead of posting a new one
+    try:
+        await q.message.edit_text(MENU_TEXT, parse_mode=ParseMode.MARKDOWN, reply_markup=KB_MAIN)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            await send_menu(q.message.chat_id, context)
+
+async def _cb_image(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await q.message.reply_text("Выбери модель для *Фото*:", parse_mode=ParseMode.MARKDOWN, reply_markup=KB_IMAGE_MODELS)
+
+async def _cb_video(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await q.message.reply_text("Выбери модель для *Видео*:", parse_mode=ParseMode.MARKDOWN, reply_markup=KB_VIDEO_MODELS)
+
+async def _cb_image_model(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await save_state(update, context, "await_prompt", {"kind": "image", "model": arg})
+    await q.message.reply_text(
+        "🖼️ Ок! Пришли *текст промпта* одним сообщением.\n\n"
+        "Подсказка: можешь вставить промпт из канала — бот понимает большие тексты.",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def _cb_video_model(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await save_state(update, context, "await_video_prompt", {"kind": "video", "model": arg})
+    await q.message.reply_text(
+        "🎥 Ок! Теперь пришли *фото* (как картинку) — потом бот попросит текст промпта для движения.",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def _cb_library(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    prompts = await _db(list_prompts, limit=8, only_new=False, preview_len=120)
+    if not prompts:
+        await q.message.reply_text("Пока база пуста. Добавь промпты комментами под постами в канале 🙂")
+        return
+    txt = "📚 *Последние промпты:*\n\n"
+    for p in prompts:
+        txt += f"• `{p['prompt_id']}` {p['text']}\n"
+    txt += "\nХочешь сохранить в избранное? Напиши: `fav 123`"
+    await q.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
+
+async def _cb_new(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    prompts = await _db(list_prompts, limit=8, only_new=True, preview_len=140)
+    if not prompts:
+        await q.message.reply_text("🆕 Новых промптов пока нет.")
+        return
+    txt = "🆕 *Новые промпты:*\n\n"
+    for p in prompts:
+        txt += f"• `{p['prompt_id']}` {p['text']}\n"
+    await _db(mark_prompts_seen, [int(p["prompt_id"]) for p in prompts])
+    await q.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
+
+async def _cb_notify(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    newv = await _db(toggle_notify, user.id)
+    await q.message.reply_text("🔔 Уведомления: " + ("ВКЛ ✅" if newv == 1 else "ВЫКЛ ❌"))
+
+async def _cb_ref(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    # bot.username is filled by get_me() once during tg_app.initialize(), no extra API call
+    await q.message.reply_text(
+        REF_TEXT.format(bot=context.bot.username, user_id=user.id),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def _cb_vip(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await q.message.reply_text(VIP_TEXT, parse_mode=ParseMode.MARKDOWN, reply_markup=KB_VIP)
+
+async def _cb_vip_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, q: CallbackQuery, user: User, arg: str) -> None:
+    await context.bot.send_invoice(chat_id=q.message.chat_id, **VIP_INVOICE)
+
+# one dict probe per button press instead of walking an if-chain
+CALLBACK_ROUTES = {
+    "check_sub": _cb_check_sub,
+    "m:back": _cb_back,
+    "m:image": _cb_image,
+    "m:video": _cb_video,
+    "m:library": _cb_library,
+    "m:new": _cb_new,
+    "m:notify": _cb_notify,
+    "m:ref": _cb_ref,
+    "m:vip": _cb_vip,
+    "vip:buy": _cb_vip_buy,
+}
+
+# parameterized buttons: "img:<model>", "vid:<model>"
+CALLBACK_PREFIX_ROUTES = {
+    "img": _cb_image_model,
+    "vid": _cb_video_model,
+}
+
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     if not q:
@@ -240,120 +535,72 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     user = update.effective_user
     if not user:
         return
-    upsert_user(user.id, user.username, user.first_name)
+    await touch_user(user, context)
+
+    data = q.data or ""
 
     # gate for everything except check_sub
-    if q.data != "check_sub":
+    if data != "check_sub":
         if not await gate_or_ask_sub(update, context):
             return
 
-    data = q.data
-
-    if data == "check_sub":
-        ok = await is_subscribed(user.id, context)
-        if not ok:
-            await q.message.reply_text("Пока не вижу подписку 😕 Подпишись и нажми ещё раз.", reply_markup=kb_subscribe())
-            return
-        await q.message.reply_text("✅ Подписка подтверждена! Добро пожаловать 🔥")
-        await send_menu(q.message.chat_id, context)
-        return
-
-    if data == "m:back":
-        await send_menu(q.message.chat_id, context)
+    handler = CALLBACK_ROUTES.get(data)
+    if handler:
+        await handler(update, context, q, user, "")
         return
 
-    if data == "m:image":
-        await q.message.reply_text("Выбери модель для *Фото*:", parse_mode=ParseMode.MARKDOWN, reply_markup=kb_image_models())
-        return
+    head, _, arg = data.partition(":")
+    handler = CALLBACK_PREFIX_ROUTES.get(head)
+    if handler:
+        await handler(update, context, q, user, arg)
 
-    if data == "m:video":
-        await q.message.reply_text("Выбери модель для *Видео*:", parse_mode=ParseMode.MARKDOWN, reply_markup=kb_video_models())
-        return
 
-    if data.startswith("img:"):
-        model = data.split(":", 1)[1]
-        set_state(user.id, "await_prompt", {"kind": "image", "model": model})
-        await q.message.reply_text(
-            "🖼️ Ок! Пришли *текст промпта* одним сообщением.\n\n"
-            "Подсказка: можешь вставить промпт из канала — бот понимает большие тексты.",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return
-
-    if data.startswith("vid:"):
-        model = data.split(":", 1)[1]
-        set_state(user.id, "await_video_prompt", {"kind": "video", "model": model})
-        await q.message.reply_text(
-            "🎥 Ок! Теперь пришли *фото* (как картинку) — потом бот попросит текст промпта для движения.",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return
+# ---------------- FREEPIK SUBMISSION ----------------
+# run as background tasks from the handlers; the result itself arrives via /webhook/freepik
+async def _submit_image(update: Update, model: Optional[str], text: str) -> None:
+    webhook_url = f"{PUBLIC_BASE_URL}/webhook/freepik"
 
-    if data == "m:library":
-        prompts = list_prompts(limit=8, only_new=False)
-        if not prompts:
-            await q.message.reply_text("Пока база пуста. Добавь промпты комментами под постами в канале 🙂")
-            return
-        txt = "📚 *Последние промпты:*\n\n"
-        for p in prompts:
-            txt += f"• `{p['prompt_id']}` {p['text'][:120]}\n"
-        txt += "\nХочешь сохранить в избранное? Напиши: `fav 123`"
-        await q.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
-        return
+    try:
+        if model == "flux":
+            res = await freepik.text_to_image_flux_dev(text, webhook_url=webhook_url)
+        elif model == "hyper":
+            res = await freepik.text_to_image_hyperflux(text, webhook_url=webhook_url)
+        elif model == "mystic":
+            res = await freepik.mystic(text, webhook_url=webhook_url)
+        else:
+            res = await freepik.text_to_image_flux_dev(text, webhook_url=webhook_url)
 
-    if data == "m:new":
-        prompts = list_prompts(limit=8, only_new=True)
-        if not prompts:
-            await q.message.reply_text("🆕 Новых промптов пока нет.")
-            return
-        txt = "🆕 *Новые промпты:*\n\n"
-        for p in prompts:
-            txt += f"• `{p['prompt_id']}` {p['text'][:140]}\n"
-            mark_prompt_seen(int(p["prompt_id"]))
-        await q.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
-        return
+        task_id = _extract_task_id(res)
+        if task_id:
+            await _db(add_freepik_task, task_id, update.effective_user.id, update.effective_chat.id, kind="image")
+        else:
+            await update.message.reply_text("⚠️ Не нашла task_id в ответе Freepik. Пришли лог ответа — подстрою парсер.")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка генерации: {e}")
 
-    if data == "m:notify":
-        newv = toggle_notify(user.id)
-        await q.message.reply_text("🔔 Уведомления: " + ("ВКЛ ✅" if newv == 1 else "ВЫКЛ ❌"))
-        return
+async def _submit_video(update: Update, context: ContextTypes.DEFAULT_TYPE, model: Optional[str], photo_file_id: str, prompt: str) -> None:
+    webhook_url = f"{PUBLIC_BASE_URL}/webhook/freepik"
 
-    if data == "m:ref":
-        link = f"https://t.me/{(await context.bot.get_me()).username}?start=ref_{user.id}"
-        await q.message.reply_text(
-            "🎁 *Твоя реферальная ссылка:*\n"
-            f"{link}\n\n"
-            "За каждого приглашённого — бонусы (можно настроить: VIP/кредиты).",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return
+    try:
+        # download photo bytes -> base64
+        file = await context.bot.get_file(photo_file_id)
+        b = await file.download_as_bytearray()
+        # multi-MB photo: encode in a worker thread, not on the event loop
+        image_b64 = await asyncio.to_thread(_b64encode, b)
+        del b
 
-    if data == "m:vip":
-        await q.message.reply_text(
-            "⭐ *VIP доступ*\n\n"
-            f"Цена: *{VIP_STARS_PRICE} ⭐*\n"
-            "VIP даёт приоритет, больше генераций, доступ к спец-разделам.",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"Купить за {VIP_STARS_PRICE} ⭐", callback_data="vip:buy")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="m:back")]
-            ])
-        )
-        return
+        if model == "kling_std":
+            res = await freepik.kling_image_to_video_standard(image_b64, prompt, webhook_url=webhook_url)
+        else:
+            res = await freepik.kling_image_to_video_pro(image_b64, prompt, webhook_url=webhook_url)
 
-    if data == "vip:buy":
-        # Stars invoices use currency XTR and empty provider_token 
-        prices = [LabeledPrice(label="VIP доступ", amount=VIP_STARS_PRICE)]
-        await context.bot.send_invoice(
-            chat_id=q.message.chat_id,
-            title="VIP доступ",
-            description="VIP доступ к Gurenko AI Agent",
-            payload="vip_299",
-            provider_token="",  # for Stars
-            currency="XTR",
-            prices=prices
-        )
-        return
+        task_id = _extract_task_id(res)
+        if task_id:
+            await _db(add_freepik_task, task_id, update.effective_user.id, update.effective_chat.id, kind="video")
+        else:
+            await update.message.reply_text("⚠️ Не нашла task_id в ответе Freepik. Пришли лог ответа — подстрою парсер.")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка генерации видео: {e}")
 
 
 # ---------------- TEXT / STATE ----------------
@@ -361,7 +608,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user or not update.message:
         return
-    upsert_user(user.id, user.username, user.first_name)
+    await touch_user(user, context)
 
     # gate
     if not await gate_or_ask_sub(update, context):
@@ -373,41 +620,26 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if text.lower().startswith("fav "):
         try:
             pid = int(text.split(" ", 1)[1].strip())
-            added = toggle_favorite(user.id, pid)
+            added = await _db(toggle_favorite, user.id, pid)
             await update.message.reply_text("⭐ В избранном!" if added else "❌ Убрала из избранного.")
         except Exception:
             await update.message.reply_text("Формат: `fav 123`", parse_mode=ParseMode.MARKDOWN)
         return
 
-    state, payload = get_state(user.id)
+    state, payload = await load_state(update, context)
 
     # image prompt
     if state == "await_prompt" and payload and payload.get("kind") == "image":
+        if not take_gen_token(user.id, context):
+            await update.message.reply_text(RATE_LIMIT_TEXT)
+            return
         model = payload.get("model")
-        set_state(user.id, None, None)
+        await save_state(update, context, None, None)
 
         await update.message.reply_text("⏳ Генерирую… Как будет готово — пришлю сюда.")
-
-        webhook_url = f"{PUBLIC_BASE_URL}/webhook/freepik"
-
-        try:
-            if model == "flux":
-                res = await freepik.text_to_image_flux_dev(text, webhook_url=webhook_url)
-            elif model == "hyper":
-                res = await freepik.text_to_image_hyperflux(text, webhook_url=webhook_url)
-            elif model == "mystic":
-                res = await freepik.mystic(text, webhook_url=webhook_url)
-            else:
-                res = await freepik.text_to_image_flux_dev(text, webhook_url=webhook_url)
-
-            # ожидаем что Freepik вернет task id
-            task_id = str(res.get("id") or res.get("data", {}).get("id") or res.get("task_id") or "")
-            if task_id:
-                add_freepik_task(task_id, user.id, update.effective_chat.id, kind="image")
-            else:
-                await update.message.reply_text("⚠️ Не нашла task_id в ответе Freepik. Пришли лог ответа — подстрою парсер.")
-        except Exception as e:
-            await update.message.reply_text(f"Ошибка генерации: {e}")
+        await context.bot.send_chat_action(update.effective_chat.id, ChatAction.UPLOAD_PHOTO)
+        # submission can wait on the Freepik rate limit/retries; don't hold the handler for it
+        context.application.create_task(_submit_image(update, model, text), update=update)
         return
 
     # video flow (step 1 -> wait photo)
@@ -424,27 +656,24 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user or not update.message:
         return
-    upsert_user(user.id, user.username, user.first_name)
+    await touch_user(user, context)
 
     # gate
     if not await gate_or_ask_sub(update, context):
         return
 
-    state, payload = get_state(user.id)
+    state, payload = await load_state(update, context)
     if state != "await_video_prompt" or not payload or payload.get("kind") != "video":
         await update.message.reply_text("Фото получила 🙂 Но чтобы сделать видео — нажми 🎥 Видео в меню.")
         return
 
-    # download photo bytes -> base64
-    photo = update.message.photo[-1]
-    file = await photo.get_file()
-    b = await file.download_as_bytearray()
-    image_b64 = base64.b64encode(bytes(b)).decode("utf-8")
+    # keep only Telegram's file_id in the state; the photo itself is fetched
+    # once the motion prompt arrives, so multi-MB base64 never lands in the DB
+    payload["photo_file_id"] = update.message.photo[-1].file_id
 
     # now ask for motion prompt
-    payload["image_b64"] = image_b64
     payload["step"] = "need_text"
-    set_state(user.id, "await_video_text", payload)
+    await save_state(update, context, "await_video_text", payload)
 
     await update.message.reply_text(
         "Отлично! Теперь пришли *текст промпта* для движения/сцены.\n"
@@ -457,37 +686,38 @@ async def on_video_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user = update.effective_user
     if not user or not update.message:
         return
-    upsert_user(user.id, user.username, user.first_name)
+    await touch_user(user, context)
 
     if not await gate_or_ask_sub(update, context):
         return
 
-    state, payload = get_state(user.id)
+    state, payload = await load_state(update, context)
     if state != "await_video_text" or not payload:
         return
 
+    # states saved before photos were kept as file_id only carry image_b64: restart the flow
+    if not payload.get("photo_file_id"):
+        await save_state(update, context, None, None)
+        await update.message.reply_text(
+            "⚠️ Не нашла твоё фото — пришли его ещё раз. Выбери модель для *Видео*:",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=KB_VIDEO_MODELS
+        )
+        raise ApplicationHandlerStop
+
+    if not take_gen_token(user.id, context):
+        await update.message.reply_text(RATE_LIMIT_TEXT)
+        # state is still await_video_text: keep on_text (group 2) from answering too
+        raise ApplicationHandlerStop
+
     model = payload.get("model")
-    image_b64 = payload.get("image_b64")
+    photo_file_id = payload.get("photo_file_id")
     prompt = (update.message.text or "").strip()
-    set_state(user.id, None, None)
+    await save_state(update, context, None, None)
 
     await update.message.reply_text("⏳ Делаю видео… пришлю результат, как будет готово.")
-
-    webhook_url = f"{PUBLIC_BASE_URL}/webhook/freepik"
-
-    try:
-        if model == "kling_std":
-            res = await freepik.kling_image_to_video_standard(image_b64, prompt, webhook_url=webhook_url)
-        else:
-            res = await freepik.kling_image_to_video_pro(image_b64, prompt, webhook_url=webhook_url)
-
-        task_id = str(res.get("id") or res.get("data", {}).get("id") or res.get("task_id") or "")
-        if task_id:
-            add_freepik_task(task_id, user.id, update.effective_chat.id, kind="video")
-        else:
-            await update.message.reply_text("⚠️ Не нашла task_id в ответе Freepik. Пришли лог ответа — подстрою парсер.")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка генерации видео: {e}")
+    await context.bot.send_chat_action(update.effective_chat.id, ChatAction.UPLOAD_VIDEO)
+    context.application.create_task(_submit_video(update, context, model, photo_file_id, prompt), update=update)
 
 
 # ---------------- PAYMENTS ----------------
@@ -503,7 +733,7 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = update.effective_user
     if not user:
         return
-    set_vip(user.id, True)
+    await _db(set_vip, user.id, True)
     await msg.reply_text("✅ VIP активирован! Спасибо 💛\n\nЖми /start и пользуйся.")
 
 
@@ -519,8 +749,7 @@ async def on_discussion_comment(update: Update, context: ContextTypes.DEFAULT_TY
     if not chat:
         return
 
-    if DISCUSSION_GROUP_ID and str(chat.id) != str(DISCUSSION_GROUP_ID):
-        return  # не наш discussion group
+    # чужие группы отсекаются фильтром хендлера (см. on_startup)
 
     r = update.message.reply_to_message
     if not r or not r.forward_from_chat:
@@ -536,17 +765,17 @@ async def on_discussion_comment(update: Update, context: ContextTypes.DEFAULT_TY
     if not prompts:
         return
 
-    for p in prompts:
-        add_prompt(
-            text=p,
-            tags="channel_comment",
-            source="telegram_comment",
-            source_chat_id=str(r.forward_from_chat.id),
-            source_post_id=str(post_id) if post_id else None,
-            created_by=update.effective_user.id if update.effective_user else None
-        )
-        # можно рассылать как "новый промпт"
-        await broadcast_new_prompt(p, context)
+    await _db(
+        add_prompts,
+        prompts,
+        tags="channel_comment",
+        source="telegram_comment",
+        source_chat_id=str(r.forward_from_chat.id),
+        source_post_id=str(post_id) if post_id else None,
+        created_by=update.effective_user.id if update.effective_user else None
+    )
+    # можно рассылать как "новый промпт" — копией самого комментария
+    broadcast_new_prompt(chat.id, update.message.message_id)
 
 
 # ---------------- WEBHOOKS ----------------
@@ -554,6 +783,25 @@ async def on_discussion_comment(update: Update, context: ContextTypes.DEFAULT_TY
 async def root() -> Dict[str, Any]:
     return {"ok": True}
 
+async def _process_update_in_order(update: Update) -> None:
+    # updates of different users run concurrently, but one user's updates run one at a time
+    # in arrival order, so e.g. a photo is never handled before the button that set the state
+    user = update.effective_user
+    if not user:
+        await tg_app.process_update(update)
+        return
+    entry = _user_locks.get(user.id)
+    if entry is None:
+        entry = _user_locks[user.id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await tg_app.process_update(update)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user.id]
+
 @app.post(f"/webhook/telegram/{TG_WEBHOOK_PATH_SECRET}")
 async def telegram_webhook(
     request: Request,
@@ -563,9 +811,19 @@ async def telegram_webhook(
         if x_telegram_bot_api_secret_token != TG_WEBHOOK_SECRET_TOKEN:
             raise HTTPException(status_code=403, detail="Bad telegram secret token")
 
-    data = await request.json()
+    data = orjson.loads(await request.body())
+
+    # Telegram redelivers an update if the ack got lost; run each update_id only once
+    update_id = data.get("update_id")
+    if update_id in _seen_updates:
+        return {"ok": True}
+    _seen_updates[update_id] = None
+    if len(_seen_updates) > SEEN_UPDATES_MAX:
+        _seen_updates.popitem(last=False)
+
     update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
+    # ack Telegram right away; handlers run as a task tracked by the Application
+    tg_app.create_task(_process_update_in_order(update), update=update)
     return {"ok": True}
 
 def _verify_freepik_signature(raw_body: bytes, signature: str, secret: str) -> bool:
@@ -578,6 +836,28 @@ def _verify_freepik_signature(raw_body: bytes, signature: str, secret: str) -> b
     # signature может приходить как hex
     return hmac.compare_digest(digest, signature)
 
+async def _deliver_freepik_result(chat_id: int, kind: str, status: str, result_url: Optional[str], payload: Dict[str, Any]) -> None:
+    if status and status.lower() in ("failed", "error"):
+        await tg_app.bot.send_message(chat_id, f"❌ Freepik: генерация не удалась.\n{payload}")
+        return
+
+    if not result_url:
+        # пришёл статус без url — просто сообщим
+        await tg_app.bot.send_message(chat_id, f"ℹ️ Freepik статус: {status}\n(жду финальный результат)")
+        return
+
+    # отправка в Telegram по типу
+    if kind == "image":
+        try:
+            await tg_app.bot.send_photo(chat_id, photo=result_url, caption="✅ Готово! 🖼️")
+        except Exception:
+            await tg_app.bot.send_message(chat_id, f"✅ Готово! Вот ссылка:\n{result_url}")
+    else:
+        try:
+            await tg_app.bot.send_video(chat_id, video=result_url, caption="✅ Готово! 🎥")
+        except Exception:
+            await tg_app.bot.send_message(chat_id, f"✅ Готово! Вот ссылка:\n{result_url}")
+
 @app.post("/webhook/freepik")
 async def freepik_webhook(
     request: Request,
@@ -590,13 +870,15 @@ async def freepik_webhook(
         if not _verify_freepik_signature(raw, x_freepik_signature or "", FREEPIK_WEBHOOK_SECRET):
             raise HTTPException(status_code=403, detail="Bad Freepik signature")
 
-    payload = json.loads(raw.decode("utf-8") or "{}")
+    payload = orjson.loads(raw or b"{}")
+
+    data = payload.get("data") or {}
 
     # ожидаем наличие task id + urls результата
-    task_id = str(payload.get("id") or payload.get("task_id") or payload.get("data", {}).get("id") or "")
-    status = str(payload.get("status") or payload.get("data", {}).get("status") or "")
+    task_id = str(payload.get("id") or payload.get("task_id") or data.get("id") or "")
+    status = str(payload.get("status") or data.get("status") or "")
 
-    task = get_freepik_task(task_id) if task_id else None
+    task = await _db(get_freepik_task, task_id) if task_id else None
     if not task:
         return {"ok": True}
 
@@ -607,45 +889,29 @@ async def freepik_webhook(
     result_url = (
         payload.get("result_url")
         or payload.get("url")
-        or payload.get("data", {}).get("url")
-        or payload.get("data", {}).get("result", {}).get("url")
+        or data.get("url")
+        or (data.get("result") or {}).get("url")
     )
 
     # fallback: список url
     if not result_url:
-        arr = payload.get("data", {}).get("urls") or payload.get("urls") or []
+        arr = data.get("urls") or payload.get("urls") or []
         if isinstance(arr, list) and arr:
             result_url = arr[0]
 
-    if status and status.lower() in ("failed", "error"):
-        await tg_app.bot.send_message(chat_id, f"❌ Freepik: генерация не удалась.\n{payload}")
-        return {"ok": True}
-
-    if not result_url:
-        # пришёл статус без url — просто сообщим
-        await tg_app.bot.send_message(chat_id, f"ℹ️ Freepik статус: {status}\n(жду финальный результат)")
-        return {"ok": True}
-
-    # отправка в Telegram по типу
-    if kind == "image":
-        try:
-            await tg_app.bot.send_photo(chat_id, photo=result_url, caption="✅ Готово! 🖼️")
-        except Exception:
-            await tg_app.bot.send_message(chat_id, f"✅ Готово! Вот ссылка:\n{result_url}")
-    else:
-        try:
-            await tg_app.bot.send_video(chat_id, video=result_url, caption="✅ Готово! 🎥")
-        except Exception:
-            await tg_app.bot.send_message(chat_id, f"✅ Готово! Вот ссылка:\n{result_url}")
-
+    # answer Freepik right away; Telegram delivery (and its fallbacks) runs in the background
+    tg_app.create_task(_deliver_freepik_result(chat_id, kind, status, result_url, payload))
     return {"ok": True}
 
 
 # ---------------- STARTUP ----------------
-@app.on_event("startup")
 async def on_startup() -> None:
+    # schema/WAL setup once per worker process, inside the server's event loop startup
+    init_db()
     await tg_app.initialize()
     await tg_app.start()
+    _background_tasks.append(asyncio.create_task(broadcast_worker()))
+    _background_tasks.append(asyncio.create_task(db_optimize_worker()))
 
     # Handlers
     tg_app.add_handler(CommandHandler("start", cmd_start))
@@ -657,8 +923,11 @@ async def on_startup() -> None:
     tg_app.add_handler(PreCheckoutQueryHandler(precheckout))
     tg_app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
 
-    # discussion comments ingest
-    tg_app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, on_discussion_comment))
+    # discussion comments ingest; when the group is known, filter it at dispatch time
+    comments_filter = filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND
+    if DISCUSSION_GROUP_ID:
+        comments_filter = comments_filter & filters.Chat(chat_id=int(DISCUSSION_GROUP_ID))
+    tg_app.add_handler(MessageHandler(comments_filter, on_discussion_comment))
 
     # stateful inputs
     tg_app.add_handler(MessageHandler(filters.PHOTO, on_photo))
@@ -667,4 +936,24 @@ async def on_startup() -> None:
 
     # set webhook
     url = f"{PUBLIC_BASE_URL}/webhook/telegram/{TG_WEBHOOK_PATH_SECRET}"
-    await tg_app.bot.set_webhook(url=url, secret_token=TG_WEBHOOK_SECRET_TOKEN if TG_WEBHOOK_SECRET_TOKEN else None)
+    await tg_app.bot.set_webhook(
+        url=url,
+        secret_token=TG_WEBHOOK_SECRET_TOKEN if TG_WEBHOOK_SECRET_TOKEN else None,
+        # only the update types the handlers above consume; Telegram skips the rest
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY],
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    log.info("Bot @%s started, webhook set to %s/webhook/telegram/...", tg_app.bot.username, PUBLIC_BASE_URL)
+
+
+async def on_shutdown() -> None:
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    if tg_app.running:
+        await tg_app.stop()
+    await tg_app.shutdown()  # no-op if initialize() never ran
+    await freepik.aclose()
+    # let queued DB writes finish without blocking the event loop while they do
+    await asyncio.to_thread(_db_executor.shutdown, wait=True)